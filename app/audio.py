@@ -1,21 +1,40 @@
 import asyncio
-import io
+import hashlib
+import heapq
 import logging
 import os
 import shutil
-import zipfile
+from collections import OrderedDict
 from pathlib import Path
 
+import aiofiles
 import httpx
 
 from app.config import (
-    DOWNLOAD_CACHE, CONVERTED_CACHE, DIRECT_STREAM_EXTENSIONS,
-    TRACKER_EXTENSIONS, CONVERSION_MAX_DURATION, OGG_QUALITY,
-    DOWNLOAD_CACHE_MAX, CONVERTED_CACHE_MAX,
+    DOWNLOAD_CACHE, CONVERTED_CACHE, EXTENSION_FLAGS, IS_TRACKER, IS_DIRECT,
+    CONVERSION_MAX_DURATION, OGG_QUALITY,
+    DOWNLOAD_CACHE_MAX, CONVERTED_CACHE_MAX, HOT_PATH_CACHE_SIZE,
+    DOWNLOAD_CHUNK_SIZE, FFMPEG_MAX_PARALLEL,
+    PIPE_CONVERT_ENABLED, PIPE_CONVERT_MAX_SIZE,
 )
+from app.remote_zip import read_remote_zip_entry
 
 log = logging.getLogger(__name__)
 
+# httpx's read timeout applies per read, so long files aren't cut off
+DOWNLOAD_TIMEOUT = httpx.Timeout(connect=10.0, read=120.0, write=None, pool=10.0)
+
+# Bounds concurrent conversions so they don't oversubscribe the CPU
+_ffmpeg_sem = asyncio.Semaphore(FFMPEG_MAX_PARALLEL)
+
+# track_id -> streamable path, least recently served first
+_hot_paths: OrderedDict[int, Path] = OrderedDict()
+
+# track_id -> in-progress prepare_track, so concurrent requests share one conversion
+_inflight: dict[int, asyncio.Future[Path | None]] = {}
+# download path -> in-progress download; only one coroutine may write a given .part
+_downloads: dict[Path, asyncio.Future[Path | None]] = {}
+
 
 def cache_path_for_download(track_id: int, filename: str) -> Path:
     return DOWNLOAD_CACHE / f"{track_id}_{filename}"
@@ -25,57 +44,125 @@ def cache_path_for_converted(track_id: int) -> Path:
     return CONVERTED_CACHE / f"{track_id}.ogg"
 
 
-def dir_size(path: Path) -> int:
-    total = 0
-    for f in path.iterdir():
-        if f.is_file():
-            total += f.stat().st_size
-    return total
+def _remember(track_id: int, path: Path) -> Path:
+    _hot_paths[track_id] = path
+    _hot_paths.move_to_end(track_id)
+    if len(_hot_paths) > HOT_PATH_CACHE_SIZE:
+        _hot_paths.popitem(last=False)
+    return path
+
+
+def _single_flight(inflight: dict, key, make) -> asyncio.Future:
+    """Join the in-progress call for key, or start it via make().
 
+    The work runs as its own task and callers await it shielded, so one
+    client disconnecting doesn't cancel it for the others.
+    """
+    fut = inflight.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(make())
+        inflight[key] = fut
+        fut.add_done_callback(lambda _: inflight.pop(key, None))
+    return asyncio.shield(fut)
+
+
+def _eviction_key(name: str) -> bytes:
+    return hashlib.blake2b(name.encode(), digest_size=8).digest()
 
-def evict_lru(cache_dir: Path, max_bytes: int):
-    """Remove oldest files until under limit."""
-    while dir_size(cache_dir) > max_bytes:
-        files = sorted(cache_dir.iterdir(), key=lambda f: f.stat().st_atime)
-        if not files:
-            break
-        oldest = files[0]
-        log.info("Evicting cached file: %s", oldest.name)
-        oldest.unlink(missing_ok=True)
+
+def evict_cache(cache_dir: Path, max_bytes: int, incoming: int = 0):
+    """Remove files in hash order until under limit, leaving room for `incoming` bytes.
+
+    Hash order needs no access tracking (atime is unreliable on noatime
+    mounts); an evicted track is simply fetched again if it's requested.
+    """
+    entries = []
+    total = incoming
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            size = entry.stat(follow_symlinks=False).st_size
+            total += size
+            entries.append((_eviction_key(entry.name), size, entry.path))
+
+    if total <= max_bytes:
+        return
+
+    heapq.heapify(entries)
+    evicted = set()
+    while total > max_bytes and entries:
+        _, size, path = heapq.heappop(entries)
+        log.info("Evicting cached file: %s", os.path.basename(path))
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        evicted.add(Path(path))
+        total -= size
+
+    for track_id, path in list(_hot_paths.items()):
+        if path in evicted:
+            del _hot_paths[track_id]
 
 
 async def download_file(url: str, dest: Path, client: httpx.AsyncClient) -> bool:
-    """Download a file from the mirror."""
+    """Download a file from the mirror, resuming an earlier partial download.
+
+    Data goes to `<dest>.part` and is renamed into place once complete, so a
+    partial file never looks like a cached one.
+    """
     if dest.exists():
         return True
+    part = dest.with_name(dest.name + ".part")
+    offset = part.stat().st_size if part.exists() else 0
+    headers = {"Accept-Encoding": "identity"}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
     try:
-        async with client.stream("GET", url, timeout=120.0) as resp:
-            if resp.status_code != 200:
+        async with client.stream("GET", url, headers=headers, timeout=DOWNLOAD_TIMEOUT) as resp:
+            if resp.status_code == 206:
+                mode = "r+b"
+            elif resp.status_code == 200:
+                mode, offset = "wb", 0
+            else:
                 log.warning("Download failed HTTP %d: %s", resp.status_code, url)
+                if resp.status_code == 416:
+                    part.unlink(missing_ok=True)
                 return False
+            # Preallocate only when Content-Length is the on-disk size
+            size = 0
+            if "Content-Encoding" not in resp.headers:
+                size = int(resp.headers.get("Content-Length", "0"))
             dest.parent.mkdir(parents=True, exist_ok=True)
-            with open(dest, "wb") as f:
-                async for chunk in resp.aiter_bytes(chunk_size=65536):
-                    f.write(chunk)
+            written = offset
+            f = await aiofiles.open(part, mode)
+            try:
+                await f.seek(offset)
+                if size and hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(f.fileno(), offset, size)
+                async for chunk in resp.aiter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    await f.write(chunk)
+                    written += len(chunk)
+            finally:
+                await f.close()
+                # Drop any preallocated tail so a resume starts at the real end
+                os.truncate(part, written)
+        os.replace(part, dest)
         return True
     except Exception as e:
         log.warning("Download error %s: %s", url, e)
-        dest.unlink(missing_ok=True)
         return False
 
 
 async def extract_from_zip(
     zip_url: str, path_in_zip: str, dest: Path, client: httpx.AsyncClient
 ) -> bool:
-    """Download ZIP, extract a specific file."""
+    """Extract a specific file from a remote ZIP using ranged fetches."""
     if dest.exists():
         return True
     try:
-        resp = await client.get(zip_url, timeout=120.0)
-        if resp.status_code != 200:
-            return False
-        zf = zipfile.ZipFile(io.BytesIO(resp.content))
-        data = zf.read(path_in_zip)
+        data = await read_remote_zip_entry(client, zip_url, path_in_zip)
         dest.parent.mkdir(parents=True, exist_ok=True)
         dest.write_bytes(data)
         return True
@@ -85,28 +172,56 @@ async def extract_from_zip(
         return False
 
 
-async def convert_to_ogg(input_path: Path, output_path: Path) -> bool:
-    """Convert tracker/other format to OGG using ffmpeg."""
+async def fetch_track_bytes(track: dict, client: httpx.AsyncClient) -> bytes | None:
+    """Fetch a track's raw file into memory without touching the download cache."""
+    try:
+        if track["source_type"] == "zip":
+            return await read_remote_zip_entry(
+                client, track["source_zip_url"], track["path_in_zip"]
+            )
+        resp = await client.get(track["remote_url"], timeout=DOWNLOAD_TIMEOUT)
+        if resp.status_code != 200:
+            log.warning("Download failed HTTP %d: %s", resp.status_code, track["remote_url"])
+            return None
+        return resp.content
+    except Exception as e:
+        log.warning("Fetch error for track %d: %s", track["id"], e)
+        return None
+
+
+async def convert_to_ogg(
+    input_path: Path | None, output_path: Path, input_bytes: bytes | None = None
+) -> bool:
+    """Convert tracker/other format to OGG using ffmpeg.
+
+    If input_bytes is given it's piped to ffmpeg's stdin and input_path is ignored.
+    """
     if output_path.exists():
         return True
+    source = "pipe:0" if input_bytes is not None else str(input_path)
     try:
-        proc = await asyncio.create_subprocess_exec(
-            "ffmpeg", "-y", "-i", str(input_path),
-            "-t", str(CONVERSION_MAX_DURATION),
-            "-c:a", "libvorbis", "-q:a", OGG_QUALITY,
-            "-vn",
-            str(output_path),
-            stdout=asyncio.subprocess.DEVNULL,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(proc.communicate(), timeout=300)
+        async with _ffmpeg_sem:
+            proc = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-y", "-loglevel", "error", "-i", source,
+                "-t", str(CONVERSION_MAX_DURATION),
+                "-c:a", "libvorbis", "-q:a", OGG_QUALITY,
+                "-threads", "1",
+                "-vn",
+                str(output_path),
+                stdin=asyncio.subprocess.PIPE if input_bytes is not None else None,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            _, stderr = await asyncio.wait_for(
+                proc.communicate(input=input_bytes), timeout=300
+            )
         if proc.returncode != 0:
             log.warning("ffmpeg conversion failed: %s", stderr.decode()[-500:])
             output_path.unlink(missing_ok=True)
             return False
         return True
     except asyncio.TimeoutError:
-        log.warning("ffmpeg conversion timed out for %s", input_path)
+        log.warning("ffmpeg conversion timed out for %s", output_path.name)
         output_path.unlink(missing_ok=True)
         return False
     except Exception as e:
@@ -115,7 +230,7 @@ async def convert_to_ogg(input_path: Path, output_path: Path) -> bool:
         return False
 
 
-async def prepare_track(track: dict) -> Path | None:
+async def prepare_track(track: dict, client: httpx.AsyncClient) -> Path | None:
     """
     Ensure a track is available for streaming. Returns path to streamable file,
     or None on failure.
@@ -123,10 +238,22 @@ async def prepare_track(track: dict) -> Path | None:
     track dict must have: id, filename, remote_url, format, source_type,
                           source_zip_url, path_in_zip
     """
+    track_id = track["id"]
+    hot = _hot_paths.get(track_id)
+    if hot is not None:
+        # The file may have been removed outside evict_cache
+        if hot.exists():
+            _hot_paths.move_to_end(track_id)
+            return hot
+        del _hot_paths[track_id]
+    return await _single_flight(_inflight, track_id, lambda: _prepare_track(track, client))
+
+
+async def _prepare_track(track: dict, client: httpx.AsyncClient) -> Path | None:
     track_id = track["id"]
     filename = track["filename"]
     fmt = track["format"]
-    source_type = track["source_type"]
+    flags = EXTENSION_FLAGS.get(fmt, 0)
 
     # Skip SID for now (no sidplayfp)
     if fmt == "sid":
@@ -137,45 +264,55 @@ async def prepare_track(track: dict) -> Path | None:
     ogg_path = cache_path_for_converted(track_id)
 
     # If already converted, serve that
-    if fmt in TRACKER_EXTENSIONS and ogg_path.exists():
-        return ogg_path
+    if flags & IS_TRACKER and ogg_path.exists():
+        return _remember(track_id, ogg_path)
     # If direct-streamable and cached
-    if fmt in DIRECT_STREAM_EXTENSIONS and dl_path.exists():
-        return dl_path
-
-    # Evict if needed
-    evict_lru(DOWNLOAD_CACHE, DOWNLOAD_CACHE_MAX)
+    if flags & IS_DIRECT and dl_path.exists():
+        return _remember(track_id, dl_path)
+
+    # Small trackers go straight from memory into ffmpeg, skipping the
+    # download cache entirely (needs a demuxer that accepts pipe input)
+    file_size = track.get("file_size")
+    if (
+        PIPE_CONVERT_ENABLED
+        and flags & IS_TRACKER
+        and file_size is not None
+        and file_size <= PIPE_CONVERT_MAX_SIZE
+        and not dl_path.exists()
+    ):
+        data = await fetch_track_bytes(track, client)
+        if data is None:
+            return None
+        evict_cache(CONVERTED_CACHE, CONVERTED_CACHE_MAX)
+        if not await convert_to_ogg(None, ogg_path, input_bytes=data):
+            return None
+        return _remember(track_id, ogg_path)
 
-    async with httpx.AsyncClient(follow_redirects=True) as client:
-        # Download/extract the raw file
-        if source_type == "zip":
-            ok = await extract_from_zip(
-                track["source_zip_url"], track["path_in_zip"], dl_path, client
-            )
-        else:
-            ok = await download_file(track["remote_url"], dl_path, client)
+    # Evict if needed, making room for the file we're about to fetch
+    evict_cache(DOWNLOAD_CACHE, DOWNLOAD_CACHE_MAX, track.get("file_size") or 0)
 
-        if not ok:
-            return None
+    # Download/extract the raw file, sharing any download already in progress
+    if await get_original_file(track, client) is None:
+        return None
 
     # For tracker formats, convert to OGG
-    if fmt in TRACKER_EXTENSIONS:
-        evict_lru(CONVERTED_CACHE, CONVERTED_CACHE_MAX)
+    if flags & IS_TRACKER:
+        evict_cache(CONVERTED_CACHE, CONVERTED_CACHE_MAX)
         ok = await convert_to_ogg(dl_path, ogg_path)
         if not ok:
             return None
-        return ogg_path
+        return _remember(track_id, ogg_path)
 
     # For wav/flac, also convert to OGG for smaller streaming
     if fmt in ("wav", "flac"):
-        evict_lru(CONVERTED_CACHE, CONVERTED_CACHE_MAX)
+        evict_cache(CONVERTED_CACHE, CONVERTED_CACHE_MAX)
         ok = await convert_to_ogg(dl_path, ogg_path)
         if not ok:
             return None
-        return ogg_path
+        return _remember(track_id, ogg_path)
 
     # MP3/OGG: serve directly
-    return dl_path
+    return _remember(track_id, dl_path)
 
 
 def content_type_for_path(path: Path) -> str:
@@ -188,18 +325,22 @@ def content_type_for_path(path: Path) -> str:
     }.get(ext, "application/octet-stream")
 
 
-async def get_original_file(track: dict) -> Path | None:
+async def get_original_file(track: dict, client: httpx.AsyncClient) -> Path | None:
     """Download the original file for upvoting/saving."""
     dl_path = cache_path_for_download(track["id"], track["filename"])
     if dl_path.exists():
         return dl_path
+    return await _single_flight(
+        _downloads, dl_path, lambda: _fetch_original(track, dl_path, client)
+    )
 
-    async with httpx.AsyncClient(follow_redirects=True) as client:
-        if track["source_type"] == "zip":
-            ok = await extract_from_zip(
-                track["source_zip_url"], track["path_in_zip"], dl_path, client
-            )
-        else:
-            ok = await download_file(track["remote_url"], dl_path, client)
+
+async def _fetch_original(track: dict, dl_path: Path, client: httpx.AsyncClient) -> Path | None:
+    if track["source_type"] == "zip":
+        ok = await extract_from_zip(
+            track["source_zip_url"], track["path_in_zip"], dl_path, client
+        )
+    else:
+        ok = await download_file(track["remote_url"], dl_path, client)
 
     return dl_path if ok else None
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -5,6 +6,9 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # Remote server
 MIRROR_BASE_URL = "http://128.237.157.9/pub/scene.org/music/"
 CATEGORIES = ["artists", "groups", "compos", "compilations", "disks"]
+HTTP_USER_AGENT = "scene-client/1"
+HTTP_MAX_KEEPALIVE = 32
+HTTP_MAX_CONNECTIONS = 64
 
 # Local paths
 DATA_DIR = BASE_DIR / "data"
@@ -15,33 +19,73 @@ ART_CACHE = CACHE_DIR / "art"
 UPVOTED_DIR = Path("/mnt/storage/scene-music")
 DB_PATH = DATA_DIR / "music.db"
 
+# Download settings
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+
 # Cache limits (bytes)
 DOWNLOAD_CACHE_MAX = 2 * 1024 * 1024 * 1024   # 2 GB
 CONVERTED_CACHE_MAX = 1 * 1024 * 1024 * 1024   # 1 GB
+HOT_PATH_CACHE_SIZE = 256  # track paths remembered in-process
 
 # Crawler settings
 CRAWL_CONCURRENCY = 5
-ZIP_INSPECT_MAX_SIZE = 5 * 1024 * 1024  # 5 MB
+CRAWL_PROGRESS_INTERVAL = 10  # seconds between progress log lines
+ZIP_INSPECT_MAX_SIZE = 5 * 1024 * 1024  # 5 MB; only for ZIPs that can't be listed by Range
 CRAWL_REFRESH_HOURS = 24
 
 # Audio settings
 CONVERSION_MAX_DURATION = 600  # seconds (10 min cap for looping trackers)
 OGG_QUALITY = "5"
+# libopenmpt needs a seekable input; enable only with an ffmpeg whose
+# tracker demuxer (e.g. libmodplug) reads from a pipe
+PIPE_CONVERT_ENABLED = False
+PIPE_CONVERT_MAX_SIZE = 4 * 1024 * 1024  # trackers up to this size skip the download cache
+FFMPEG_MAX_PARALLEL = max(1, (os.cpu_count() or 2) // 2)  # single-threaded ffmpegs at once
 
 # Supported formats
-AUDIO_EXTENSIONS = {
+AUDIO_EXTENSIONS = frozenset({
     "mp3", "ogg", "wav", "flac",
     "mod", "xm", "it", "s3m", "stm", "mtm", "med", "669", "far", "ult",
     "sid",
-}
-TRACKER_EXTENSIONS = {
+})
+TRACKER_EXTENSIONS = frozenset({
     "mod", "xm", "it", "s3m", "stm", "mtm", "med", "669", "far", "ult",
+})
+DIRECT_STREAM_EXTENSIONS = frozenset({"mp3", "ogg"})
+ART_FILENAMES = frozenset({"cover.png", "cover.jpg", "cover.gif", "folder.png", "folder.jpg"})
+ART_CONTENT_TYPES = {"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg", "gif": "image/gif"}
+
+# Filename classification bits, see classify()
+IS_AUDIO, IS_TRACKER, IS_DIRECT, IS_ART = 1, 2, 4, 8
+EXTENSION_FLAGS = {
+    ext: IS_AUDIO
+    | (IS_TRACKER if ext in TRACKER_EXTENSIONS else 0)
+    | (IS_DIRECT if ext in DIRECT_STREAM_EXTENSIONS else 0)
+    for ext in AUDIO_EXTENSIONS
 }
-DIRECT_STREAM_EXTENSIONS = {"mp3", "ogg"}
-ART_FILENAMES = {"cover.png", "cover.jpg", "cover.gif", "folder.png", "folder.jpg"}
+
+
+def classify(name: str) -> tuple[str, int]:
+    """Return (lowercased extension, IS_* flags) for a filename."""
+    lower = name.lower()
+    dot = lower.rfind(".")
+    ext = lower[dot + 1:] if dot != -1 else ""
+    flags = EXTENSION_FLAGS.get(ext, 0)
+    if lower in ART_FILENAMES:
+        flags |= IS_ART
+    return ext, flags
+
+# API settings
+STATUS_CACHE_SECONDS = 5  # /api/status is polled by the UI
+STREAM_CHUNK_SIZE = 1024 * 1024  # read size when the app streams audio itself
+PLAY_COUNT_FLUSH_SECONDS = 5  # buffered play counts are written this often
+# When behind nginx, set to an internal location aliased to CACHE_DIR
+# (e.g. "/_internal/") and nginx will send the audio files instead
+ACCEL_REDIRECT_PREFIX: str | None = None
 
 # Shuffle settings
 RECENT_REPEAT_WINDOW = 50  # avoid replaying last N tracks
+SHUFFLE_PICK_ATTEMPTS = 5  # random id probes before falling back to ORDER BY RANDOM()
 
 # Ensure dirs exist
 for d in [DATA_DIR, DOWNLOAD_CACHE, CONVERTED_CACHE, ART_CACHE, UPVOTED_DIR]:
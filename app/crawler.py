@@ -1,27 +1,37 @@
 import asyncio
+import functools
 import logging
 import re
 import zipfile
-import io
 from datetime import datetime, timezone
 from urllib.parse import urljoin, unquote
 
 import httpx
 
 from app.config import (
-    MIRROR_BASE_URL, CATEGORIES, AUDIO_EXTENSIONS, ART_FILENAMES,
-    CRAWL_CONCURRENCY, ZIP_INSPECT_MAX_SIZE,
+    MIRROR_BASE_URL, CATEGORIES, IS_AUDIO, IS_ART, ART_CONTENT_TYPES, classify,
+    CRAWL_CONCURRENCY, CRAWL_PROGRESS_INTERVAL, ZIP_INSPECT_MAX_SIZE,
 )
-from app.database import get_db, set_state
+from app.database import set_state, transaction
+from app.remote_zip import ArchiveTooLarge, list_remote_zip
 
 log = logging.getLogger(__name__)
 
+# Unlike INSERT OR IGNORE, a no-op DO UPDATE still returns the existing row's id
+UPSERT_COLLECTION = """
+    INSERT INTO collections(category_id, name, remote_path) VALUES(?, ?, ?)
+    ON CONFLICT(remote_path) DO UPDATE SET remote_path=excluded.remote_path
+    RETURNING id
+"""
+
 # Matches Apache HTML table directory listing rows like:
 # <td><a href="file.zip">file.zip</a></td><td align="right">14-Apr-2002 11:45  </td><td align="right"> 73K</td>
+# Possessive quantifiers (*+, ++) never give back characters, so a malformed
+# row fails in linear time instead of backtracking.
 LISTING_RE = re.compile(
-    r'<a href="([^"]+)">([^<]+)</a></td>'
-    r'\s*<td[^>]*>\s*(\d{2}-\w{3}-\d{4}\s+\d{2}:\d{2})\s*</td>'
-    r'\s*<td[^>]*>\s*([\d.]+[KMG]?|-)\s*</td>',
+    rb'<a href="([^"]++)">([^<]++)</a></td>'
+    rb'\s*+<td[^>]*+>\s*+(\d{2}-\w{3}-\d{4}\s++\d{2}:\d{2})\s*+</td>'
+    rb'\s*+<td[^>]*+>\s*+([\d.]++[KMG]?|-)\s*+</td>',
     re.IGNORECASE,
 )
 
@@ -40,19 +50,29 @@ def parse_size(s: str) -> int | None:
         return None
 
 
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=8192)
 def clean_title(filename: str) -> str:
     name = filename.rsplit(".", 1)[0] if "." in filename else filename
     name = name.replace("_", " ").replace("-", " ")
-    name = re.sub(r"\s+", " ", name).strip()
+    name = WHITESPACE_RE.sub(" ", name).strip()
     return name or filename
 
 
-def parse_listing(html: str, base_url: str) -> tuple[list[dict], list[dict]]:
-    """Parse Apache directory listing HTML. Returns (dirs, files)."""
+def art_content_type(ext: str) -> str:
+    return ART_CONTENT_TYPES.get(ext, "application/octet-stream")
+
+
+def parse_listing(html: bytes, base_url: str) -> tuple[list[dict], list[dict]]:
+    """Parse raw Apache directory listing HTML. Returns (dirs, files)."""
     dirs = []
     files = []
     for match in LISTING_RE.finditer(html):
-        href, _name, _date, size_str = match.groups()
+        # Apache percent-encodes hrefs, so latin-1 is a lossless byte-for-byte decode
+        href = match[1].decode("latin-1")
+        size_str = match[4].decode("latin-1")
         if href.startswith("?") or href.startswith("/"):
             continue
         decoded = unquote(href)
@@ -60,12 +80,13 @@ def parse_listing(html: str, base_url: str) -> tuple[list[dict], list[dict]]:
         if href.endswith("/"):
             dirs.append({"name": decoded.rstrip("/"), "url": full_url})
         else:
-            ext = decoded.rsplit(".", 1)[-1].lower() if "." in decoded else ""
+            ext, flags = classify(decoded)
             size = parse_size(size_str)
             files.append({
                 "name": decoded,
                 "url": full_url,
                 "ext": ext,
+                "flags": flags,
                 "size": size,
             })
     return dirs, files
@@ -79,7 +100,7 @@ async def fetch_listing(client: httpx.AsyncClient, url: str, semaphore: asyncio.
             if resp.status_code != 200:
                 log.warning("HTTP %d for %s", resp.status_code, url)
                 return None, [], []
-            dirs, files = parse_listing(resp.text, url)
+            dirs, files = parse_listing(resp.content, url)
             return resp.status_code, dirs, files
         except Exception as e:
             log.warning("Failed to fetch %s: %s", url, e)
@@ -99,50 +120,48 @@ async def crawl_collection(
     if status is None:
         return
 
-    await db.execute(
-        "INSERT OR REPLACE INTO crawl_log(url, crawled_at, status_code) VALUES(?, ?, ?)",
-        (url, datetime.now(timezone.utc).isoformat(), status),
-    )
-
-    # Detect art
-    art_url = None
+    # Catalog ZIPs first so this listing's own writes stay one short transaction
     for f in files:
-        if f["name"].lower() in ART_FILENAMES:
-            art_url = f["url"]
-            break
+        if f["ext"] == "zip":
+            await inspect_zip(client, f["url"], collection_id, db, semaphore)
 
-    # Insert tracks
-    for f in files:
-        if f["ext"] in AUDIO_EXTENSIONS:
-            title = clean_title(f["name"])
-            try:
-                await db.execute(
-                    """INSERT OR IGNORE INTO tracks
-                       (collection_id, filename, title, remote_url, format, source_type, file_size)
-                       VALUES (?, ?, ?, ?, ?, 'direct', ?)""",
-                    (collection_id, f["name"], title, f["url"], f["ext"], f["size"]),
-                )
-            except Exception as e:
-                log.warning("Failed to insert track %s: %s", f["name"], e)
+    # Detect art
+    art = next((f for f in files if f["flags"] & IS_ART), None)
+    art_url = art["url"] if art else None
+    art_type = art_content_type(art["ext"]) if art else None
 
-        elif f["ext"] == "zip" and f["size"] and f["size"] <= ZIP_INSPECT_MAX_SIZE:
-            await inspect_zip(client, f["url"], collection_id, db, semaphore)
+    track_rows = [
+        (collection_id, f["name"], clean_title(f["name"]), f["url"], f["ext"], f["size"])
+        for f in files if f["flags"] & IS_AUDIO
+    ]
 
-    if art_url:
+    now = datetime.now(timezone.utc).isoformat()
+    async with transaction(db):
         await db.execute(
-            "UPDATE collections SET art_url=? WHERE id=?", (art_url, collection_id)
+            "INSERT OR REPLACE INTO crawl_log(url, crawled_at, status_code) VALUES(?, ?, ?)",
+            (url, now, status),
         )
 
-    # Update track count
-    cursor = await db.execute(
-        "SELECT COUNT(*) as cnt FROM tracks WHERE collection_id=?", (collection_id,)
-    )
-    row = await cursor.fetchone()
-    await db.execute(
-        "UPDATE collections SET track_count=?, crawled_at=? WHERE id=?",
-        (row["cnt"], datetime.now(timezone.utc).isoformat(), collection_id),
-    )
-    await db.commit()
+        if track_rows:
+            await db.executemany(
+                """INSERT OR IGNORE INTO tracks
+                   (collection_id, filename, title, remote_url, format, source_type, file_size)
+                   VALUES (?, ?, ?, ?, ?, 'direct', ?)""",
+                track_rows,
+            )
+
+        # Update track count, and art if this listing has any
+        cursor = await db.execute(
+            "SELECT COUNT(*) as cnt FROM tracks WHERE collection_id=?", (collection_id,)
+        )
+        row = await cursor.fetchone()
+        await db.execute(
+            """UPDATE collections SET track_count=?, crawled_at=?,
+                      art_url=COALESCE(?, art_url),
+                      art_content_type=COALESCE(?, art_content_type)
+               WHERE id=?""",
+            (row["cnt"], now, art_url, art_type, collection_id),
+        )
 
     # Recurse into subdirectories (still same collection)
     for d in dirs:
@@ -157,17 +176,12 @@ async def crawl_one_collection(
     dir_entry: dict, db, semaphore: asyncio.Semaphore,
 ):
     """Create one collection row, then crawl its contents."""
-    await db.execute(
-        """INSERT OR IGNORE INTO collections(category_id, name, remote_path)
-           VALUES(?, ?, ?)""",
-        (category_id, dir_entry["name"], dir_entry["url"]),
-    )
-    await db.commit()
-
-    cursor = await db.execute(
-        "SELECT id FROM collections WHERE remote_path=?", (dir_entry["url"],)
-    )
-    row = await cursor.fetchone()
+    async with transaction(db):
+        cursor = await db.execute(
+            UPSERT_COLLECTION,
+            (category_id, dir_entry["name"], dir_entry["url"]),
+        )
+        row = await cursor.fetchone()
     if row:
         await crawl_collection(
             client, dir_entry["url"], category_id, row["id"], db, semaphore,
@@ -187,152 +201,165 @@ async def crawl_category(
         log.warning("Failed to fetch category listing: %s", cat_name)
         return
 
-    await db.execute(
-        "INSERT OR REPLACE INTO crawl_log(url, crawled_at, status_code) VALUES(?, ?, ?)",
-        (cat_url, datetime.now(timezone.utc).isoformat(), status),
-    )
-    await db.commit()
+    async with transaction(db):
+        await db.execute(
+            "INSERT OR REPLACE INTO crawl_log(url, crawled_at, status_code) VALUES(?, ?, ?)",
+            (cat_url, datetime.now(timezone.utc).isoformat(), status),
+        )
 
-    # Fan out: crawl all subdirectories (collections) concurrently
-    tasks = []
+    # Fan out: a fixed pool of workers pulls subdirectories (collections) off
+    # a queue, so one slow collection never holds up the others
+    queue: asyncio.Queue[dict] = asyncio.Queue()
     for d in dirs:
-        tasks.append(
-            crawl_one_collection(client, cat_id, d, db, semaphore)
-        )
+        queue.put_nowait(d)
+    done = 0
 
-    # Run in batches to avoid overwhelming things
-    batch_size = 20
-    for i in range(0, len(tasks), batch_size):
-        batch = tasks[i:i + batch_size]
-        await asyncio.gather(*batch, return_exceptions=True)
-        # Be polite to the server
-        await asyncio.sleep(0.2)
-        # Log progress
-        done = min(i + batch_size, len(tasks))
+    async def worker():
+        nonlocal done
+        while True:
+            d = await queue.get()
+            try:
+                await crawl_one_collection(client, cat_id, d, db, semaphore)
+            except Exception as e:
+                log.warning("Failed to crawl collection %s: %s", d["url"], e)
+            finally:
+                done += 1
+                queue.task_done()
+
+    async def log_progress():
         cursor = await db.execute("SELECT COUNT(*) as cnt FROM tracks")
         row = await cursor.fetchone()
         log.info("  %s: %d/%d collections crawled, %d tracks total",
-                 cat_name, done, len(tasks), row["cnt"])
+                 cat_name, done, len(dirs), row["cnt"])
+
+    async def report_progress():
+        while True:
+            await asyncio.sleep(CRAWL_PROGRESS_INTERVAL)
+            await log_progress()
+
+    workers = [asyncio.create_task(worker()) for _ in range(CRAWL_CONCURRENCY)]
+    reporter = asyncio.create_task(report_progress())
+    try:
+        await queue.join()
+    finally:
+        for t in (*workers, reporter):
+            t.cancel()
+        await asyncio.gather(*workers, reporter, return_exceptions=True)
+    await log_progress()
 
     # Any audio files at category level become a misc collection
-    audio_at_root = [f for f in files if f["ext"] in AUDIO_EXTENSIONS]
+    audio_at_root = [f for f in files if f["flags"] & IS_AUDIO]
     if audio_at_root:
         misc_name = f"_misc_{cat_name}"
-        await db.execute(
-            """INSERT OR IGNORE INTO collections(category_id, name, remote_path)
-               VALUES(?, ?, ?)""",
-            (cat_id, misc_name, cat_url),
-        )
-        await db.commit()
-        cursor = await db.execute(
-            "SELECT id FROM collections WHERE remote_path=?", (cat_url,)
-        )
-        row = await cursor.fetchone()
-        if row:
-            for f in audio_at_root:
-                title = clean_title(f["name"])
-                await db.execute(
+        async with transaction(db):
+            cursor = await db.execute(
+                UPSERT_COLLECTION, (cat_id, misc_name, cat_url)
+            )
+            row = await cursor.fetchone()
+            if row:
+                await db.executemany(
                     """INSERT OR IGNORE INTO tracks
                        (collection_id, filename, title, remote_url, format, source_type, file_size)
                        VALUES (?, ?, ?, ?, ?, 'direct', ?)""",
-                    (row["id"], f["name"], title, f["url"], f["ext"], f["size"]),
+                    [
+                        (row["id"], f["name"], clean_title(f["name"]), f["url"], f["ext"], f["size"])
+                        for f in audio_at_root
+                    ],
+                )
+                await db.execute(
+                    "UPDATE collections SET track_count=? WHERE id=?",
+                    (len(audio_at_root), row["id"]),
                 )
-            await db.execute(
-                "UPDATE collections SET track_count=? WHERE id=?",
-                (len(audio_at_root), row["id"]),
-            )
-            await db.commit()
 
 
 async def inspect_zip(
     client: httpx.AsyncClient, zip_url: str, collection_id: int,
     db, semaphore: asyncio.Semaphore,
 ):
-    """Download a small ZIP and catalog audio files inside it."""
+    """Catalog audio files inside a ZIP from its central directory."""
     async with semaphore:
         try:
-            resp = await client.get(zip_url, timeout=60.0)
-            if resp.status_code != 200:
-                return
+            entries = await list_remote_zip(client, zip_url, ZIP_INSPECT_MAX_SIZE)
+        except ArchiveTooLarge as e:
+            log.info("Skipping ZIP that needs a full download: %s", e)
+            return
+        except zipfile.BadZipFile:
+            log.warning("Bad ZIP file: %s", zip_url)
+            return
         except Exception as e:
-            log.warning("Failed to download ZIP %s: %s", zip_url, e)
+            log.warning("Failed to read ZIP %s: %s", zip_url, e)
             return
 
     try:
-        zf = zipfile.ZipFile(io.BytesIO(resp.content))
-        for info in zf.infolist():
-            if info.is_dir():
+        zip_rows = []
+        art_path = art_type = None
+        for info in entries:
+            if info["is_dir"]:
                 continue
-            name = info.filename.split("/")[-1]
-            ext = name.rsplit(".", 1)[-1].lower() if "." in name else ""
-            if ext in AUDIO_EXTENSIONS:
-                title = clean_title(name)
-                remote_key = f"{zip_url}!/{info.filename}"
-                try:
-                    await db.execute(
-                        """INSERT OR IGNORE INTO tracks
-                           (collection_id, filename, title, remote_url, format,
-                            source_type, source_zip_url, path_in_zip, file_size)
-                           VALUES (?, ?, ?, ?, ?, 'zip', ?, ?, ?)""",
-                        (collection_id, name, title, remote_key, ext,
-                         zip_url, info.filename, info.file_size),
-                    )
-                except Exception as e:
-                    log.warning("Failed to insert ZIP track %s: %s", name, e)
+            name = info["filename"].split("/")[-1]
+            ext, flags = classify(name)
+            if flags & IS_AUDIO:
+                zip_rows.append((
+                    collection_id, name, clean_title(name), f"{zip_url}!/{info['filename']}",
+                    ext, zip_url, info["filename"], info["file_size"],
+                ))
 
             # Check for art inside ZIP
-            lower = name.lower()
-            if lower in ART_FILENAMES:
+            if art_path is None and flags & IS_ART:
+                art_path = info["filename"]
+                art_type = art_content_type(ext)
+
+        async with transaction(db):
+            if zip_rows:
+                await db.executemany(
+                    """INSERT OR IGNORE INTO tracks
+                       (collection_id, filename, title, remote_url, format,
+                        source_type, source_zip_url, path_in_zip, file_size)
+                       VALUES (?, ?, ?, ?, ?, 'zip', ?, ?, ?)""",
+                    zip_rows,
+                )
+            if art_path:
                 await db.execute(
-                    "UPDATE collections SET art_url=? WHERE id=? AND art_url IS NULL",
-                    (f"zip:{zip_url}!/{info.filename}", collection_id),
+                    """UPDATE collections SET art_url=?, art_content_type=?
+                       WHERE id=? AND art_url IS NULL""",
+                    (f"zip:{zip_url}!/{art_path}", art_type, collection_id),
                 )
-
-        await db.commit()
-    except zipfile.BadZipFile:
-        log.warning("Bad ZIP file: %s", zip_url)
     except Exception as e:
         log.warning("Error inspecting ZIP %s: %s", zip_url, e)
 
 
-async def run_full_crawl():
+async def run_full_crawl(db, client: httpx.AsyncClient):
     """Crawl all categories from the mirror."""
-    await set_state("crawl_status", "running")
+    await set_state(db, "crawl_status", "running")
     log.info("Starting full crawl of %s", MIRROR_BASE_URL)
 
-    db = await get_db()
     semaphore = asyncio.Semaphore(CRAWL_CONCURRENCY)
 
     try:
         # Insert categories
-        for cat_name in CATEGORIES:
-            cat_url = MIRROR_BASE_URL + cat_name + "/"
-            await db.execute(
+        async with transaction(db):
+            await db.executemany(
                 "INSERT OR IGNORE INTO categories(name, remote_path) VALUES(?, ?)",
-                (cat_name, cat_url),
+                [(cat_name, MIRROR_BASE_URL + cat_name + "/") for cat_name in CATEGORIES],
             )
-        await db.commit()
 
-        async with httpx.AsyncClient(follow_redirects=True) as client:
-            for cat_name in CATEGORIES:
-                cursor = await db.execute(
-                    "SELECT id FROM categories WHERE name=?", (cat_name,)
-                )
-                row = await cursor.fetchone()
-                if not row:
-                    continue
-                await crawl_category(client, cat_name, row["id"], db, semaphore)
+        for cat_name in CATEGORIES:
+            cursor = await db.execute(
+                "SELECT id FROM categories WHERE name=?", (cat_name,)
+            )
+            row = await cursor.fetchone()
+            if not row:
+                continue
+            await crawl_category(client, cat_name, row["id"], db, semaphore)
 
         # Final counts
         cursor = await db.execute("SELECT COUNT(*) as cnt FROM tracks")
         row = await cursor.fetchone()
         log.info("Crawl complete. Total tracks: %d", row["cnt"])
-        await set_state("crawl_status", "complete")
-        await set_state("last_crawl", datetime.now(timezone.utc).isoformat())
+        await set_state(db, "crawl_status", "complete")
+        await set_state(db, "last_crawl", datetime.now(timezone.utc).isoformat())
 
     except Exception as e:
         log.error("Crawl failed: %s", e)
-        await set_state("crawl_status", f"error: {e}")
+        await set_state(db, "crawl_status", f"error: {e}")
         raise
-    finally:
-        await db.close()
@@ -1,4 +1,9 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 import aiosqlite
+from fastapi import Request
+
 from app.config import DB_PATH
 
 SCHEMA = """
@@ -37,7 +42,7 @@ CREATE TABLE IF NOT EXISTS tracks (
 CREATE TABLE IF NOT EXISTS shuffle_history (
     id INTEGER PRIMARY KEY,
     track_id INTEGER NOT NULL REFERENCES tracks(id),
-    played_at TEXT NOT NULL DEFAULT (datetime('now'))
+    played_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
 );
 
 CREATE TABLE IF NOT EXISTS crawl_log (
@@ -52,48 +57,147 @@ CREATE TABLE IF NOT EXISTS app_state (
     value TEXT
 );
 
-CREATE INDEX IF NOT EXISTS idx_tracks_collection ON tracks(collection_id);
+CREATE INDEX IF NOT EXISTS idx_tracks_collection_filename ON tracks(collection_id, filename);
 CREATE INDEX IF NOT EXISTS idx_tracks_format ON tracks(format);
 CREATE INDEX IF NOT EXISTS idx_tracks_upvoted ON tracks(upvoted);
-CREATE INDEX IF NOT EXISTS idx_collections_category ON collections(category_id);
+CREATE INDEX IF NOT EXISTS idx_collections_cat_name ON collections(category_id, name);
+CREATE INDEX IF NOT EXISTS idx_collections_name ON collections(name, id);
 CREATE INDEX IF NOT EXISTS idx_shuffle_history_played ON shuffle_history(played_at);
 """
 
+# Applied in order on top of SCHEMA; PRAGMA user_version counts how many have run
+MIGRATIONS = [
+    """
+    ALTER TABLE collections ADD COLUMN art_content_type TEXT;
+    UPDATE collections SET art_content_type = CASE
+        WHEN lower(art_url) LIKE '%.png' THEN 'image/png'
+        WHEN lower(art_url) LIKE '%.jpg' OR lower(art_url) LIKE '%.jpeg' THEN 'image/jpeg'
+        WHEN lower(art_url) LIKE '%.gif' THEN 'image/gif'
+    END
+    WHERE art_url IS NOT NULL;
+    """,
+    # Superseded by the (collection_id, filename) and (category_id, name)
+    # indexes; gather stats once so the planner picks between the composites
+    """
+    DROP INDEX IF EXISTS idx_tracks_collection;
+    DROP INDEX IF EXISTS idx_collections_category;
+    ANALYZE;
+    """,
+    # SQLite can't change a column default in place; rebuild so played_at
+    # defaults to ISO 8601 UTC, matching the rows written from Python
+    """
+    CREATE TABLE shuffle_history_new (
+        id INTEGER PRIMARY KEY,
+        track_id INTEGER NOT NULL REFERENCES tracks(id),
+        played_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+    );
+    INSERT INTO shuffle_history_new(id, track_id, played_at)
+        SELECT id, track_id, played_at FROM shuffle_history;
+    DROP TABLE shuffle_history;
+    ALTER TABLE shuffle_history_new RENAME TO shuffle_history;
+    CREATE INDEX IF NOT EXISTS idx_shuffle_history_played ON shuffle_history(played_at);
+    """,
+    # No query filters tracks on (collection_id, format); collection lookups
+    # use idx_tracks_collection_filename, so this was only crawl write cost
+    """
+    DROP INDEX IF EXISTS idx_tracks_collection_format;
+    """,
+]
+
 
-async def get_db() -> aiosqlite.Connection:
+PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "foreign_keys=ON",
+    "busy_timeout=5000",
+    "cache_size=-65536",     # 64 MB page cache
+    "mmap_size=268435456",   # 256 MB memory-mapped reads
+    "temp_store=MEMORY",
+    "wal_autocheckpoint=1000",
+)
+
+
+async def connect(readonly: bool = False) -> aiosqlite.Connection:
     db = await aiosqlite.connect(str(DB_PATH))
     db.row_factory = aiosqlite.Row
-    await db.execute("PRAGMA journal_mode=WAL")
-    await db.execute("PRAGMA foreign_keys=ON")
+    for pragma in PRAGMAS:
+        await db.execute(f"PRAGMA {pragma}")
+    if readonly:
+        await db.execute("PRAGMA query_only=ON")
     return db
 
 
-async def init_db():
-    db = await get_db()
+@asynccontextmanager
+async def db_lifespan(app):
+    """Hold a reader and a writer connection open for the app's lifetime.
+
+    Keeping them open preserves the page cache across requests; with WAL,
+    reads on app.state.db never wait behind writes on app.state.db_writer.
+    """
+    app.state.db_writer = await connect()
+    await init_db(app.state.db_writer)
+    # Refresh planner statistics that are missing or stale; cheap when nothing changed
+    await app.state.db_writer.execute("PRAGMA optimize=0x10002")
+    app.state.db = await connect(readonly=True)
     try:
-        await db.executescript(SCHEMA)
-        await db.commit()
+        yield
     finally:
-        await db.close()
+        await app.state.db.close()
+        await app.state.db_writer.close()
 
 
-async def get_state(key: str, default: str | None = None) -> str | None:
-    db = await get_db()
-    try:
-        cursor = await db.execute("SELECT value FROM app_state WHERE key=?", (key,))
-        row = await cursor.fetchone()
-        return row["value"] if row else default
-    finally:
-        await db.close()
+def get_db(request: Request) -> aiosqlite.Connection:
+    """FastAPI dependency: the shared read connection."""
+    return request.app.state.db
 
 
-async def set_state(key: str, value: str):
-    db = await get_db()
-    try:
-        await db.execute(
-            "INSERT INTO app_state(key, value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value=?",
-            (key, value, value),
-        )
+def get_writer(request: Request) -> aiosqlite.Connection:
+    """FastAPI dependency: the shared write connection; use with transaction()."""
+    return request.app.state.db_writer
+
+
+# Serializes explicit transactions; requests and crawl tasks share the writer
+_write_lock = asyncio.Lock()
+
+
+@asynccontextmanager
+async def transaction(db: aiosqlite.Connection):
+    """Run the enclosed writes as one BEGIN ... COMMIT, rolling back on error."""
+    async with _write_lock:
+        await db.execute("BEGIN")
+        try:
+            yield db
+        except BaseException:
+            await db.rollback()
+            raise
         await db.commit()
-    finally:
-        await db.close()
+
+
+async def init_db(db: aiosqlite.Connection):
+    await db.executescript(SCHEMA)
+    cursor = await db.execute("PRAGMA user_version")
+    version = (await cursor.fetchone())[0]
+    for i, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        await db.executescript(f"BEGIN; {script} PRAGMA user_version={i}; COMMIT;")
+    await db.commit()
+
+
+async def get_state(
+    db: aiosqlite.Connection, key: str, default: str | None = None
+) -> str | None:
+    cursor = await db.execute("SELECT value FROM app_state WHERE key=?", (key,))
+    row = await cursor.fetchone()
+    return row["value"] if row else default
+
+
+async def write_state(db: aiosqlite.Connection, key: str, value: str):
+    """Upsert an app_state key inside the caller's transaction()."""
+    await db.execute(
+        "INSERT INTO app_state(key, value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value=?",
+        (key, value, value),
+    )
+
+
+async def set_state(db: aiosqlite.Connection, key: str, value: str):
+    async with transaction(db):
+        await write_state(db, key, value)
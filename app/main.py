@@ -1,20 +1,24 @@
 import asyncio
-import io
 import logging
-import zipfile
+import os
+import time
+from collections import defaultdict, deque
 from contextlib import asynccontextmanager
 from pathlib import Path
 
 import httpx
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse, Response
+from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
 
 from app.config import (
     BASE_DIR, DOWNLOAD_CACHE, CONVERTED_CACHE, ART_CACHE, UPVOTED_DIR,
+    HTTP_USER_AGENT, HTTP_MAX_KEEPALIVE, HTTP_MAX_CONNECTIONS, STATUS_CACHE_SECONDS,
+    RECENT_REPEAT_WINDOW, PLAY_COUNT_FLUSH_SECONDS,
 )
-from app.database import init_db, get_db, get_state
+from app.database import db_lifespan, get_state, transaction
 from app.crawler import run_full_crawl
+from app.remote_zip import read_remote_zip_entry
 from app.models import StatusOut
 
 logging.basicConfig(
@@ -26,33 +30,98 @@ log = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await init_db()
+    # Long-lived reader/writer connections so the page cache survives across requests
+    async with db_lifespan(app):
+        # One pooled client shared by crawling, playback and art fetches
+        app.state.http = httpx.AsyncClient(
+            http2=True,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                max_connections=HTTP_MAX_CONNECTIONS,
+            ),
+            timeout=httpx.Timeout(120.0, connect=10.0),
+            headers={"User-Agent": HTTP_USER_AGENT},
+        )
+        app.state.status_cache = None  # (expires_at, StatusOut)
+        app.state.max_track_id = None  # shuffle probe range, see player._max_track_id
+        app.state.min_history_id = None  # see player._min_history_id
+        app.state.play_counts = defaultdict(int)  # track_id -> plays not yet written
+
+        # Track ids the shuffle avoids repeating, newest first
+        rows = await app.state.db.execute_fetchall(
+            "SELECT track_id FROM shuffle_history ORDER BY id DESC LIMIT ?",
+            (RECENT_REPEAT_WINDOW,),
+        )
+        app.state.recent = deque((r["track_id"] for r in rows), maxlen=RECENT_REPEAT_WINDOW)
 
-    # Check if DB already has tracks — skip crawl if so
-    db = await get_db()
-    try:
-        cursor = await db.execute("SELECT COUNT(*) as cnt FROM tracks")
+        # Check if DB already has tracks — skip crawl if so
+        cursor = await app.state.db.execute("SELECT COUNT(*) as cnt FROM tracks")
         row = await cursor.fetchone()
         track_count = row["cnt"]
-    finally:
-        await db.close()
 
-    task = None
-    if track_count > 0:
-        log.info("DB has %d tracks, skipping crawl", track_count)
-    else:
-        log.info("DB is empty, starting crawl")
-        task = asyncio.create_task(run_full_crawl())
+        task = None
+        if track_count > 0:
+            log.info("DB has %d tracks, skipping crawl", track_count)
+        else:
+            log.info("DB is empty, starting crawl")
+            task = asyncio.create_task(run_full_crawl(app.state.db_writer, app.state.http))
+            # New tracks extend the shuffle probe range
+            task.add_done_callback(lambda _: setattr(app.state, "max_track_id", None))
 
-    yield
+        flusher = asyncio.create_task(_play_count_flusher(app))
 
-    if task is not None:
-        task.cancel()
+        yield
+
+        flusher.cancel()
         try:
-            await task
-        except (asyncio.CancelledError, Exception):
+            await flusher
+        except asyncio.CancelledError:
             pass
 
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+        # The crawl is stopped, so this can't wait behind its transactions
+        try:
+            await _flush_play_counts(app)
+        except Exception as e:
+            log.warning("Final play count flush failed: %s", e)
+
+        await app.state.http.aclose()
+
+
+async def _flush_play_counts(app: FastAPI):
+    """Write buffered play counts in one transaction."""
+    counts, app.state.play_counts = app.state.play_counts, defaultdict(int)
+    if not counts:
+        return
+    try:
+        async with transaction(app.state.db_writer):
+            await app.state.db_writer.executemany(
+                "UPDATE tracks SET play_count = play_count + ? WHERE id=?",
+                [(n, track_id) for track_id, n in counts.items()],
+            )
+    except Exception:
+        # Keep them for the next attempt
+        for track_id, n in counts.items():
+            app.state.play_counts[track_id] += n
+        raise
+
+
+async def _play_count_flusher(app: FastAPI):
+    """Flush play counts every PLAY_COUNT_FLUSH_SECONDS instead of once per stream."""
+    while True:
+        await asyncio.sleep(PLAY_COUNT_FLUSH_SECONDS)
+        try:
+            await _flush_play_counts(app)
+        except Exception as e:
+            log.warning("Play count flush failed: %s", e)
+
 
 app = FastAPI(title="scene.org Music Discovery", lifespan=lifespan)
 
@@ -67,66 +136,78 @@ app.include_router(upvote_router)
 
 
 def _dir_size_mb(path: Path) -> float:
-    total = sum(f.stat().st_size for f in path.iterdir() if f.is_file())
+    with os.scandir(path) as it:
+        total = sum(
+            e.stat(follow_symlinks=False).st_size
+            for e in it if e.is_file(follow_symlinks=False)
+        )
     return round(total / (1024 * 1024), 1)
 
 
 @app.get("/api/status")
 async def status() -> StatusOut:
-    db = await get_db()
-    try:
-        crawl_status = await get_state("crawl_status", "idle")
-
-        cat_c = await db.execute("SELECT COUNT(*) as cnt FROM categories")
-        cat_row = await cat_c.fetchone()
-
-        coll_c = await db.execute("SELECT COUNT(*) as cnt FROM collections")
-        coll_row = await coll_c.fetchone()
-
-        track_c = await db.execute("SELECT COUNT(*) as cnt FROM tracks")
-        track_row = await track_c.fetchone()
-
-        upvoted_c = await db.execute("SELECT COUNT(*) as cnt FROM tracks WHERE upvoted=1")
-        upvoted_row = await upvoted_c.fetchone()
-
-        return StatusOut(
-            crawl_status=crawl_status,
-            total_categories=cat_row["cnt"],
-            total_collections=coll_row["cnt"],
-            total_tracks=track_row["cnt"],
-            download_cache_mb=_dir_size_mb(DOWNLOAD_CACHE),
-            converted_cache_mb=_dir_size_mb(CONVERTED_CACHE),
-            upvoted_count=upvoted_row["cnt"],
-        )
-    finally:
-        await db.close()
+    cached = app.state.status_cache
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    crawl_status = await get_state(app.state.db, "crawl_status", "idle")
+
+    cursor = await app.state.db.execute("""
+        SELECT (SELECT COUNT(*) FROM categories) as cats,
+               (SELECT COUNT(*) FROM collections) as colls,
+               (SELECT COUNT(*) FROM tracks) as trks,
+               (SELECT COUNT(*) FROM tracks WHERE upvoted=1) as upv
+    """)
+    row = await cursor.fetchone()
+
+    result = StatusOut(
+        crawl_status=crawl_status,
+        total_categories=row["cats"],
+        total_collections=row["colls"],
+        total_tracks=row["trks"],
+        download_cache_mb=_dir_size_mb(DOWNLOAD_CACHE),
+        converted_cache_mb=_dir_size_mb(CONVERTED_CACHE),
+        upvoted_count=row["upv"],
+    )
+
+    app.state.status_cache = (time.monotonic() + STATUS_CACHE_SECONDS, result)
+    return result
+
+
+def _sniff_image_type(head: bytes) -> str:
+    """Guess an image content type from its first 12 bytes."""
+    if head[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if head[:4] == b"GIF8":
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+
+def _art_response(cache_file: Path, media_type: str | None) -> FileResponse:
+    if media_type is None:
+        with open(cache_file, "rb") as f:
+            media_type = _sniff_image_type(f.read(12))
+    return FileResponse(cache_file, media_type=media_type)
 
 
 @app.get("/api/art/{collection_id}")
 async def get_art(collection_id: int):
-    db = await get_db()
-    try:
-        cursor = await db.execute(
-            "SELECT art_url FROM collections WHERE id=?", (collection_id,)
-        )
-        row = await cursor.fetchone()
-        if not row or not row["art_url"]:
-            raise HTTPException(404, "No art available")
-        art_url = row["art_url"]
-    finally:
-        await db.close()
+    cursor = await app.state.db.execute(
+        "SELECT art_url, art_content_type FROM collections WHERE id=?", (collection_id,)
+    )
+    row = await cursor.fetchone()
+    if not row or not row["art_url"]:
+        raise HTTPException(404, "No art available")
+    art_url = row["art_url"]
+    # Set at crawl time; only rows from before that was tracked need sniffing
+    art_type = row["art_content_type"]
 
     # Check cache
     cache_file = ART_CACHE / f"{collection_id}.img"
     if cache_file.exists():
-        # Detect content type from first bytes
-        data = cache_file.read_bytes()
-        ct = "image/png"
-        if data[:3] == b"\xff\xd8\xff":
-            ct = "image/jpeg"
-        elif data[:4] == b"GIF8":
-            ct = "image/gif"
-        return Response(content=data, media_type=ct)
+        return _art_response(cache_file, art_type)
 
     # Fetch from server
     try:
@@ -134,26 +215,15 @@ async def get_art(collection_id: int):
             # Format: zip:<zip_url>!/<path_in_zip>
             rest = art_url[4:]
             zip_url, path_in_zip = rest.split("!/", 1)
-            async with httpx.AsyncClient(follow_redirects=True) as client:
-                resp = await client.get(zip_url, timeout=60.0)
-                if resp.status_code != 200:
-                    raise HTTPException(502, "Failed to fetch ZIP for art")
-                zf = zipfile.ZipFile(io.BytesIO(resp.content))
-                data = zf.read(path_in_zip)
+            data = await read_remote_zip_entry(app.state.http, zip_url, path_in_zip)
         else:
-            async with httpx.AsyncClient(follow_redirects=True) as client:
-                resp = await client.get(art_url, timeout=30.0)
-                if resp.status_code != 200:
-                    raise HTTPException(502, "Failed to fetch art")
-                data = resp.content
+            resp = await app.state.http.get(art_url, timeout=30.0)
+            if resp.status_code != 200:
+                raise HTTPException(502, "Failed to fetch art")
+            data = resp.content
 
         cache_file.write_bytes(data)
-        ct = "image/png"
-        if data[:3] == b"\xff\xd8\xff":
-            ct = "image/jpeg"
-        elif data[:4] == b"GIF8":
-            ct = "image/gif"
-        return Response(content=data, media_type=ct)
+        return _art_response(cache_file, art_type)
 
     except HTTPException:
         raise
@@ -29,6 +29,12 @@ class CollectionOut(BaseModel):
     track_count: int = 0
 
 
+class CollectionPage(BaseModel):
+    items: list[CollectionOut] = []
+    next_cursor: str | None = None
+    total: int | None = None  # only with include_total=true
+
+
 class CollectionDetail(CollectionOut):
     tracks: list[TrackOut] = []
     category_name: str = ""
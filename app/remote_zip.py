@@ -0,0 +1,197 @@
+import io
+import struct
+import zipfile
+import zlib
+
+import httpx
+
+# ZIP record layouts (APPNOTE.TXT 4.3.7, 4.3.12, 4.3.16)
+EOCD_SIG = b"PK\x05\x06"
+EOCD_STRUCT = struct.Struct("<4s4H2IH")
+CD_SIG = b"PK\x01\x02"
+CD_STRUCT = struct.Struct("<4s6H3I5H2I")
+LOCAL_SIG = b"PK\x03\x04"
+LOCAL_STRUCT = struct.Struct("<4s5H3I2H")
+
+# EOCD record plus the largest possible archive comment
+EOCD_SEARCH = EOCD_STRUCT.size + 0xFFFF
+# Extra bytes fetched after a member in case its local extra field is longer
+LOCAL_SLACK = 1024
+ZIP64_MARKER = 0xFFFFFFFF
+
+
+class ArchiveTooLarge(Exception):
+    """Listing the archive would mean downloading more than the allowed size."""
+
+
+def _check_size(url: str, size: int, max_size: int | None):
+    if max_size is not None and size > max_size:
+        raise ArchiveTooLarge(f"{url} is {size} bytes, over the {max_size} byte limit")
+
+
+async def _get(client: httpx.AsyncClient, url: str, byte_range: str | None = None) -> httpx.Response:
+    headers = {"Range": f"bytes={byte_range}"} if byte_range else None
+    resp = await client.get(url, headers=headers, timeout=60.0)
+    resp.raise_for_status()
+    return resp
+
+
+async def _whole_archive(client: httpx.AsyncClient, url: str) -> zipfile.ZipFile:
+    resp = await _get(client, url)
+    return zipfile.ZipFile(io.BytesIO(resp.content))
+
+
+def _entry_from_info(info: zipfile.ZipInfo) -> dict:
+    return {
+        "filename": info.filename,
+        "is_dir": info.is_dir(),
+        "file_size": info.file_size,
+        "compress_size": info.compress_size,
+        "compress_type": info.compress_type,
+        "flag_bits": info.flag_bits,
+        "crc": info.CRC,
+        "header_offset": info.header_offset,
+        "name_len": len(info.orig_filename.encode()),
+        "extra_len": len(info.extra),
+    }
+
+
+def _parse_central_directory(cd: bytes) -> list[dict] | None:
+    """Parse central directory records. Returns None if the archive needs ZIP64."""
+    entries = []
+    pos = 0
+    while pos + CD_STRUCT.size <= len(cd) and cd[pos:pos + 4] == CD_SIG:
+        (_, _, _, flags, method, _, _, crc, csize, usize,
+         name_len, extra_len, comment_len, _, _, _, offset) = CD_STRUCT.unpack_from(cd, pos)
+        if ZIP64_MARKER in (csize, usize, offset):
+            return None
+        raw_name = cd[pos + CD_STRUCT.size:pos + CD_STRUCT.size + name_len]
+        filename = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+        entries.append({
+            "filename": filename,
+            "is_dir": filename.endswith("/"),
+            "file_size": usize,
+            "compress_size": csize,
+            "compress_type": method,
+            "flag_bits": flags,
+            "crc": crc,
+            "header_offset": offset,
+            "name_len": name_len,
+            "extra_len": extra_len,
+        })
+        pos += CD_STRUCT.size + name_len + extra_len + comment_len
+    return entries
+
+
+async def _fetch_tail(
+    client: httpx.AsyncClient, url: str, max_size: int | None
+) -> tuple[bytes, int | None]:
+    """Fetch the last EOCD_SEARCH bytes; returns (data, total size).
+
+    total is None when the server ignored Range and data is the whole
+    archive, which is read no further than max_size.
+    """
+    headers = {"Range": f"bytes=-{EOCD_SEARCH}"}
+    async with client.stream("GET", url, headers=headers, timeout=60.0) as resp:
+        resp.raise_for_status()
+        if resp.status_code == 206:
+            total = int(resp.headers["Content-Range"].rsplit("/", 1)[1])
+            return await resp.aread(), total
+
+        length = resp.headers.get("Content-Length")
+        if length is not None:
+            _check_size(url, int(length), max_size)
+        body = bytearray()
+        async for chunk in resp.aiter_bytes():
+            body += chunk
+            _check_size(url, len(body), max_size)
+        return bytes(body), None
+
+
+async def _central_directory(
+    client: httpx.AsyncClient, url: str, max_size: int | None = None
+) -> tuple[list[dict], zipfile.ZipFile | None]:
+    """Fetch and parse the central directory with ranged GETs.
+
+    Returns (entries, zf); zf is set when the whole archive had to be
+    downloaded (no Range support or ZIP64), and should be read from directly.
+    Raises ArchiveTooLarge if that download would exceed max_size.
+    """
+    tail, total = await _fetch_tail(client, url, max_size)
+    if total is None:
+        # Server ignored the Range header and sent the whole archive
+        zf = zipfile.ZipFile(io.BytesIO(tail))
+        return [_entry_from_info(i) for i in zf.infolist()], zf
+
+    tail_start = total - len(tail)
+
+    pos = tail.rfind(EOCD_SIG)
+    if pos < 0 or pos + EOCD_STRUCT.size > len(tail):
+        raise zipfile.BadZipFile("End of central directory not found")
+    _, _, _, _, count, cd_size, cd_offset, _ = EOCD_STRUCT.unpack_from(tail, pos)
+
+    entries = None
+    if count != 0xFFFF and cd_offset != ZIP64_MARKER:
+        if cd_offset >= tail_start:
+            cd = tail[cd_offset - tail_start:cd_offset - tail_start + cd_size]
+        else:
+            cd = (await _get(client, url, f"{cd_offset}-{cd_offset + cd_size - 1}")).content
+        entries = _parse_central_directory(cd)
+
+    if entries is None:
+        _check_size(url, total, max_size)
+        zf = await _whole_archive(client, url)
+        return [_entry_from_info(i) for i in zf.infolist()], zf
+    return entries, None
+
+
+async def list_remote_zip(
+    client: httpx.AsyncClient, url: str, max_size: int | None = None
+) -> list[dict]:
+    """List a remote ZIP's members without downloading their contents.
+
+    max_size bounds the whole-archive fallback; see _central_directory.
+    """
+    entries, _ = await _central_directory(client, url, max_size)
+    return entries
+
+
+async def read_remote_zip_entry(client: httpx.AsyncClient, url: str, name: str) -> bytes:
+    """Fetch and decompress a single member of a remote ZIP."""
+    entries, zf = await _central_directory(client, url)
+    if zf is not None:
+        return zf.read(name)
+
+    entry = next((e for e in entries if e["filename"] == name), None)
+    if entry is None:
+        raise KeyError(f"There is no item named {name!r} in the archive")
+
+    method = entry["compress_type"]
+    if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) or entry["flag_bits"] & 0x1:
+        # Unusual compression or encryption: let zipfile deal with it
+        zf = await _whole_archive(client, url)
+        return zf.read(name)
+
+    start = entry["header_offset"]
+    csize = entry["compress_size"]
+    end = start + LOCAL_STRUCT.size + entry["name_len"] + entry["extra_len"] + csize + LOCAL_SLACK
+    chunk = (await _get(client, url, f"{start}-{end - 1}")).content
+
+    if chunk[:4] != LOCAL_SIG:
+        raise zipfile.BadZipFile(f"Bad local file header for {name}")
+    *_, name_len, extra_len = LOCAL_STRUCT.unpack_from(chunk)
+    data_start = LOCAL_STRUCT.size + name_len + extra_len
+    raw = chunk[data_start:data_start + csize]
+    if len(raw) < csize:
+        missing_from = start + data_start + len(raw)
+        raw += (await _get(client, url, f"{missing_from}-{start + data_start + csize - 1}")).content
+
+    if method == zipfile.ZIP_DEFLATED:
+        d = zlib.decompressobj(-15)
+        data = d.decompress(raw) + d.flush()
+    else:
+        data = raw
+
+    if zlib.crc32(data) != entry["crc"]:
+        raise zipfile.BadZipFile(f"Bad CRC-32 for {name}")
+    return data
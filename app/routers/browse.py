@@ -1,131 +1,160 @@
+import asyncio
 import logging
 
-from fastapi import APIRouter, HTTPException, Query
+import aiosqlite
+from fastapi import APIRouter, Depends, HTTPException, Query
 
 from app.database import get_db
-from app.models import CategoryOut, CollectionOut, CollectionDetail, TrackOut
+from app.models import CategoryOut, CollectionOut, CollectionPage, CollectionDetail, TrackOut
 
 log = logging.getLogger(__name__)
 router = APIRouter(prefix="/api", tags=["browse"])
 
 
+async def _fetchone(db: aiosqlite.Connection, sql: str, params: tuple):
+    cursor = await db.execute(sql, params)
+    return await cursor.fetchone()
+
+
 @router.get("/categories")
-async def list_categories() -> list[CategoryOut]:
-    db = await get_db()
-    try:
-        cursor = await db.execute("""
-            SELECT c.id, c.name,
-                   (SELECT COUNT(*) FROM collections WHERE category_id=c.id) as collection_count,
-                   (SELECT COUNT(*) FROM tracks t
-                    JOIN collections col ON t.collection_id=col.id
-                    WHERE col.category_id=c.id) as track_count
-            FROM categories c ORDER BY c.name
-        """)
-        rows = await cursor.fetchall()
-        return [
-            CategoryOut(
-                id=r["id"], name=r["name"],
-                collection_count=r["collection_count"],
-                track_count=r["track_count"],
-            )
-            for r in rows
-        ]
-    finally:
-        await db.close()
+async def list_categories(db: aiosqlite.Connection = Depends(get_db)) -> list[CategoryOut]:
+    cursor = await db.execute("""
+        SELECT c.id, c.name,
+               COUNT(DISTINCT col.id) as collection_count,
+               COUNT(t.id) as track_count
+        FROM categories c
+        LEFT JOIN collections col ON col.category_id=c.id
+        LEFT JOIN tracks t ON t.collection_id=col.id
+        GROUP BY c.id, c.name
+        ORDER BY c.name
+    """)
+    rows = await cursor.fetchall()
+    return [
+        CategoryOut.model_construct(
+            id=r["id"], name=r["name"],
+            collection_count=r["collection_count"],
+            track_count=r["track_count"],
+        )
+        for r in rows
+    ]
 
 
 @router.get("/collections")
 async def list_collections(
     category: str | None = None,
     q: str | None = None,
-    offset: int = Query(0, ge=0),
+    cursor: str | None = None,
+    offset: int = Query(0, ge=0, description="Slow on deep pages; prefer cursor"),
     limit: int = Query(50, ge=1, le=200),
-) -> list[CollectionOut]:
-    db = await get_db()
-    try:
-        conditions = []
-        params: list = []
-
-        if category:
-            conditions.append(
-                "col.category_id = (SELECT id FROM categories WHERE name=?)"
-            )
-            params.append(category)
-
-        if q:
-            conditions.append("col.name LIKE ?")
-            params.append(f"%{q}%")
-
-        where = "WHERE " + " AND ".join(conditions) if conditions else ""
-
-        cursor = await db.execute(
-            f"""SELECT col.* FROM collections col {where}
-                ORDER BY col.name
-                LIMIT ? OFFSET ?""",
-            params + [limit, offset],
+    include_total: bool = Query(False, description="Also count all matches (scans them)"),
+    db: aiosqlite.Connection = Depends(get_db),
+) -> CollectionPage:
+    conditions = []
+    params: list = []
+
+    if category:
+        conditions.append(
+            "col.category_id = (SELECT id FROM categories WHERE name=?)"
         )
-        rows = await cursor.fetchall()
-        return [
-            CollectionOut(
-                id=r["id"],
-                category_id=r["category_id"],
-                name=r["name"],
-                remote_path=r["remote_path"],
-                art_url=r["art_url"],
-                track_count=r["track_count"],
-            )
-            for r in rows
-        ]
-    finally:
-        await db.close()
-
-
-@router.get("/collections/{collection_id}")
-async def get_collection(collection_id: int) -> CollectionDetail:
-    db = await get_db()
-    try:
-        cursor = await db.execute(
-            "SELECT * FROM collections WHERE id=?", (collection_id,)
+        params.append(category)
+
+    if q:
+        conditions.append("col.name LIKE ?")
+        params.append(f"%{q}%")
+
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    # The total covers the whole listing, so it uses the filters without the cursor
+    count_sql = f"SELECT COUNT(*) as cnt FROM collections col {where}"
+    count_params = tuple(params)
+
+    # Keyset pagination: resume after the last (name, id) of the previous page
+    if cursor:
+        after_name, _, after_id = cursor.rpartition("|")
+        if not after_id.isdigit():
+            raise HTTPException(400, "Invalid cursor")
+        conditions.append("(col.name, col.id) > (?, ?)")
+        params += [after_name, int(after_id)]
+        offset = 0
+        where = "WHERE " + " AND ".join(conditions)
+
+    page_sql = f"""SELECT col.id, col.category_id, col.name, col.remote_path,
+                          col.art_url, col.track_count
+                   FROM collections col {where}
+                   ORDER BY col.name, col.id
+                   LIMIT ? OFFSET ?"""
+    page_params = (*params, limit, offset)
+    if include_total:
+        rows, count_row = await asyncio.gather(
+            db.execute_fetchall(page_sql, page_params),
+            _fetchone(db, count_sql, count_params),
         )
-        row = await cursor.fetchone()
-        if not row:
-            raise HTTPException(404, "Collection not found")
-
-        cat_cursor = await db.execute(
-            "SELECT name FROM categories WHERE id=?", (row["category_id"],)
+        total = count_row["cnt"]
+    else:
+        rows = await db.execute_fetchall(page_sql, page_params)
+        total = None
+    items = [
+        CollectionOut.model_construct(
+            id=r["id"],
+            category_id=r["category_id"],
+            name=r["name"],
+            remote_path=r["remote_path"],
+            art_url=r["art_url"],
+            track_count=r["track_count"],
         )
-        cat_row = await cat_cursor.fetchone()
+        for r in rows
+    ]
+    next_cursor = f"{items[-1].name}|{items[-1].id}" if len(items) == limit else None
+    return CollectionPage.model_construct(items=items, next_cursor=next_cursor, total=total)
+
 
-        tracks_cursor = await db.execute(
-            "SELECT * FROM tracks WHERE collection_id=? ORDER BY filename",
+@router.get("/collections/{collection_id}")
+async def get_collection(
+    collection_id: int, db: aiosqlite.Connection = Depends(get_db)
+) -> CollectionDetail:
+    # Both lookups only need the id, so run them together; execute_fetchall
+    # is one hop to aiosqlite's worker thread instead of execute + fetch
+    coll_rows, track_rows = await asyncio.gather(
+        db.execute_fetchall(
+            """SELECT col.*, cat.name AS category_name FROM collections col
+               LEFT JOIN categories cat ON cat.id = col.category_id
+               WHERE col.id=?""",
             (collection_id,),
+        ),
+        db.execute_fetchall(
+            """SELECT id, collection_id, filename, title, format, source_type,
+                      file_size, upvoted, play_count
+               FROM tracks WHERE collection_id=? ORDER BY filename""",
+            (collection_id,),
+        ),
+    )
+    if not coll_rows:
+        raise HTTPException(404, "Collection not found")
+    row = coll_rows[0]
+
+    # Unpack positionally; collections can hold hundreds of tracks
+    tracks = [
+        TrackOut.model_construct(
+            id=tid,
+            collection_id=cid,
+            filename=filename,
+            title=title,
+            format=fmt,
+            source_type=source_type,
+            file_size=file_size,
+            upvoted=bool(upvoted),
+            play_count=play_count,
         )
-        track_rows = await tracks_cursor.fetchall()
-
-        tracks = [
-            TrackOut(
-                id=t["id"],
-                collection_id=t["collection_id"],
-                filename=t["filename"],
-                title=t["title"],
-                format=t["format"],
-                source_type=t["source_type"],
-                file_size=t["file_size"],
-                upvoted=bool(t["upvoted"]),
-                play_count=t["play_count"],
-            )
-            for t in track_rows
-        ]
-
-        return CollectionDetail(
-            id=row["id"],
-            category_id=row["category_id"],
-            name=row["name"],
-            remote_path=row["remote_path"],
-            art_url=row["art_url"],
-            track_count=row["track_count"],
-            tracks=tracks,
-            category_name=cat_row["name"] if cat_row else "",
-        )
-    finally:
-        await db.close()
+        for tid, cid, filename, title, fmt, source_type, file_size, upvoted, play_count
+        in track_rows
+    ]
+
+    return CollectionDetail.model_construct(
+        id=row["id"],
+        category_id=row["category_id"],
+        name=row["name"],
+        remote_path=row["remote_path"],
+        art_url=row["art_url"],
+        track_count=row["track_count"],
+        tracks=tracks,
+        category_name=row["category_name"] or "",
+    )
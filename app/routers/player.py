@@ -1,20 +1,32 @@
+import asyncio
+import json
 import logging
-from datetime import datetime, timezone
+import random
+from urllib.parse import quote
 
-from fastapi import APIRouter, HTTPException, Query
-from fastapi.responses import FileResponse
+import aiosqlite
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import FileResponse, Response
 
-from app.database import get_db
+from app.database import get_db, get_writer, get_state, set_state, write_state, transaction
 from app.models import PlayerState, TrackOut, CollectionOut
 from app.audio import prepare_track, content_type_for_path
-from app.config import RECENT_REPEAT_WINDOW
+from app.config import (
+    CACHE_DIR, SHUFFLE_PICK_ATTEMPTS,
+    STREAM_CHUNK_SIZE, ACCEL_REDIRECT_PREFIX,
+)
 
 log = logging.getLogger(__name__)
 router = APIRouter(prefix="/api/player", tags=["player"])
 
 
+class _AudioFileResponse(FileResponse):
+    # Starlette reads 64 KiB at a time; fewer, larger reads free up the event loop
+    chunk_size = STREAM_CHUNK_SIZE
+
+
 async def _track_to_out(row) -> TrackOut:
-    return TrackOut(
+    return TrackOut.model_construct(
         id=row["id"],
         collection_id=row["collection_id"],
         filename=row["filename"],
@@ -27,14 +39,10 @@ async def _track_to_out(row) -> TrackOut:
     )
 
 
-async def _collection_out(db, collection_id: int) -> CollectionOut | None:
-    cursor = await db.execute(
-        "SELECT * FROM collections WHERE id=?", (collection_id,)
-    )
-    row = await cursor.fetchone()
-    if not row:
+def _collection_out(row) -> CollectionOut | None:
+    if row is None:
         return None
-    return CollectionOut(
+    return CollectionOut.model_construct(
         id=row["id"],
         category_id=row["category_id"],
         name=row["name"],
@@ -44,120 +52,107 @@ async def _collection_out(db, collection_id: int) -> CollectionOut | None:
     )
 
 
-async def _category_name(db, category_id: int) -> str:
-    cursor = await db.execute("SELECT name FROM categories WHERE id=?", (category_id,))
-    row = await cursor.fetchone()
-    return row["name"] if row else ""
+async def _fetchone(db, sql: str, params: tuple = ()):
+    cursor = await db.execute(sql, params)
+    return await cursor.fetchone()
 
 
-async def _build_player_state(db, track_row) -> PlayerState:
-    track = await _track_to_out(track_row)
-    collection = await _collection_out(db, track.collection_id)
-    cat_name = await _category_name(db, collection.category_id) if collection else ""
-
-    cursor = await db.execute("SELECT COUNT(*) as cnt FROM shuffle_history")
-    row = await cursor.fetchone()
-    total = row["cnt"]
+async def _min_history_id(db, state) -> int | None:
+    """MIN(shuffle_history.id), cached on app.state; history is never deleted."""
+    if state.min_history_id is None:
+        row = await _fetchone(db, "SELECT MIN(id) as min_id FROM shuffle_history")
+        state.min_history_id = row["min_id"]
+    return state.min_history_id
 
-    cursor2 = await db.execute(
-        "SELECT MAX(id) as max_id FROM shuffle_history"
-    )
-    max_row = await cursor2.fetchone()
-
-    # Check current position
-    from app.database import get_state
-    pos_str = await get_state("shuffle_position")
-    current_pos = int(pos_str) if pos_str else (max_row["max_id"] if max_row and max_row["max_id"] else 0)
 
-    # Has prev?
-    cursor3 = await db.execute(
-        "SELECT id FROM shuffle_history WHERE id < ? ORDER BY id DESC LIMIT 1",
-        (current_pos,)
+async def _build_player_state(db, state, track_row, position: int) -> PlayerState:
+    """Build the response for the track at shuffle_history id `position`."""
+    track = await _track_to_out(track_row)
+    coll_row, min_id = await asyncio.gather(
+        _fetchone(
+            db,
+            """SELECT col.*, cat.name AS category_name FROM collections col
+               LEFT JOIN categories cat ON cat.id = col.category_id
+               WHERE col.id=?""",
+            (track.collection_id,),
+        ),
+        _min_history_id(db, state),
     )
-    prev_row = await cursor3.fetchone()
 
-    return PlayerState(
+    return PlayerState.model_construct(
         track=track,
-        collection=collection,
-        category_name=cat_name,
-        history_position=current_pos,
-        has_prev=prev_row is not None,
+        collection=_collection_out(coll_row),
+        category_name=(coll_row["category_name"] or "") if coll_row else "",
+        history_position=position,
+        has_prev=min_id is not None and position > min_id,
     )
 
 
 @router.get("/current")
-async def get_current() -> PlayerState:
-    db = await get_db()
-    try:
-        from app.database import get_state
-        pos_str = await get_state("shuffle_position")
-
-        if pos_str:
-            cursor = await db.execute(
-                """SELECT t.* FROM tracks t
-                   JOIN shuffle_history sh ON sh.track_id = t.id
-                   WHERE sh.id = ?""",
-                (int(pos_str),)
-            )
-            row = await cursor.fetchone()
-            if row:
-                return await _build_player_state(db, row)
-
-        # No current track - pick one
-        return await _pick_next(db)
-    finally:
-        await db.close()
-
-
-async def _pick_next(db, scope: str = "track", current_collection_id: int | None = None) -> PlayerState:
+async def get_current(
+    request: Request,
+    db: aiosqlite.Connection = Depends(get_db),
+    writer: aiosqlite.Connection = Depends(get_writer),
+) -> PlayerState:
+    pos_str = await get_state(db, "shuffle_position")
+
+    if pos_str:
+        cursor = await db.execute(
+            """SELECT t.* FROM tracks t
+               JOIN shuffle_history sh ON sh.track_id = t.id
+               WHERE sh.id = ?""",
+            (int(pos_str),)
+        )
+        row = await cursor.fetchone()
+        if row:
+            return await _build_player_state(db, request.app.state, row, int(pos_str))
+
+    # No current track - pick one
+    return await _pick_next(db, writer, request.app.state)
+
+
+# Constant SQL text so the connection's statement cache reuses the plan; the
+# recent ids arrive as one JSON array instead of a variable-length IN list
+_PICK_FILTER = """
+    format != 'sid'
+    AND (:exclude_collection IS NULL OR collection_id != :exclude_collection)
+    AND id NOT IN (SELECT value FROM json_each(:recent))
+"""
+PICK_PROBE_SQL = f"SELECT * FROM tracks WHERE id = :start AND {_PICK_FILTER}"
+PICK_RANDOM_SQL = f"SELECT * FROM tracks WHERE {_PICK_FILTER} ORDER BY RANDOM() LIMIT 1"
+
+
+async def _max_track_id(db, state) -> int:
+    """MAX(tracks.id), cached on app.state until the next crawl finishes."""
+    if state.max_track_id is None:
+        row = await _fetchone(db, "SELECT MAX(id) as max_id FROM tracks")
+        state.max_track_id = row["max_id"] or 0
+    return state.max_track_id
+
+
+async def _pick_next(
+    db, writer, state, scope: str = "track", current_collection_id: int | None = None
+) -> PlayerState:
     """Pick a random next track, avoiding recent repeats."""
-    # Get recent track IDs to avoid
-    cursor = await db.execute(
-        "SELECT track_id FROM shuffle_history ORDER BY id DESC LIMIT ?",
-        (RECENT_REPEAT_WINDOW,)
-    )
-    recent = [r["track_id"] for r in await cursor.fetchall()]
-
-    if scope == "collection" and current_collection_id:
-        # Pick from a different collection
-        if recent:
-            placeholders = ",".join("?" * len(recent))
-            query = f"""
-                SELECT t.* FROM tracks t
-                WHERE t.collection_id != ?
-                AND t.id NOT IN ({placeholders})
-                AND t.format != 'sid'
-                ORDER BY RANDOM() LIMIT 1
-            """
-            params = [current_collection_id] + recent
-        else:
-            query = """
-                SELECT t.* FROM tracks t
-                WHERE t.collection_id != ?
-                AND t.format != 'sid'
-                ORDER BY RANDOM() LIMIT 1
-            """
-            params = [current_collection_id]
-        cursor = await db.execute(query, params)
-    else:
-        if recent:
-            placeholders = ",".join("?" * len(recent))
-            query = f"""
-                SELECT * FROM tracks
-                WHERE id NOT IN ({placeholders})
-                AND format != 'sid'
-                ORDER BY RANDOM() LIMIT 1
-            """
-            cursor = await db.execute(query, recent)
-        else:
-            query = """
-                SELECT * FROM tracks
-                WHERE format != 'sid'
-                ORDER BY RANDOM() LIMIT 1
-            """
-            cursor = await db.execute(query)
+    params = {
+        "exclude_collection": current_collection_id if scope == "collection" else None,
+        "recent": json.dumps(list(state.recent)),
+    }
+
+    # Probe random ids by primary key rather than sorting the whole table.
+    # Only an exact hit counts: taking the next eligible id instead would hand
+    # each run of excluded or missing ids' odds to the track after it
+    row = None
+    max_id = await _max_track_id(db, state)
+    for _ in range(SHUFFLE_PICK_ATTEMPTS if max_id else 0):
+        cursor = await db.execute(PICK_PROBE_SQL, {**params, "start": random.randint(1, max_id)})
+        row = await cursor.fetchone()
+        if row:
+            break
 
-    row = await cursor.fetchone()
+    if not row:
+        cursor = await db.execute(PICK_RANDOM_SQL, params)
+        row = await cursor.fetchone()
 
     if not row:
         # Fallback: any track
@@ -169,104 +164,100 @@ async def _pick_next(db, scope: str = "track", current_collection_id: int | None
     if not row:
         return PlayerState()
 
-    # Record in history
-    await db.execute(
-        "INSERT INTO shuffle_history(track_id, played_at) VALUES(?, ?)",
-        (row["id"], datetime.now(timezone.utc).isoformat()),
-    )
-    await db.commit()
-
-    # Get the new history entry ID
-    cursor2 = await db.execute("SELECT last_insert_rowid() as lid")
-    lid_row = await cursor2.fetchone()
-    new_pos = lid_row["lid"]
+    # Record in history and move the position there, committed together
+    async with transaction(writer):
+        # played_at comes from the column default
+        cursor2 = await writer.execute(
+            "INSERT INTO shuffle_history(track_id) VALUES(?) RETURNING id", (row["id"],)
+        )
+        new_pos = (await cursor2.fetchone())["id"]
+        await write_state(writer, "shuffle_position", str(new_pos))
 
-    from app.database import set_state
-    await set_state("shuffle_position", str(new_pos))
+    state.recent.appendleft(row["id"])
 
-    return await _build_player_state(db, row)
+    return await _build_player_state(db, state, row, new_pos)
 
 
 @router.post("/next")
-async def next_track(scope: str = Query("track", pattern="^(track|collection)$")) -> PlayerState:
-    db = await get_db()
-    try:
-        # Get current collection for scope-aware skip
-        from app.database import get_state
-        pos_str = await get_state("shuffle_position")
-        current_coll_id = None
-        if pos_str:
-            cursor = await db.execute(
-                """SELECT t.collection_id FROM tracks t
-                   JOIN shuffle_history sh ON sh.track_id = t.id
-                   WHERE sh.id = ?""",
-                (int(pos_str),)
-            )
-            row = await cursor.fetchone()
-            if row:
-                current_coll_id = row["collection_id"]
-
-        return await _pick_next(db, scope, current_coll_id)
-    finally:
-        await db.close()
+async def next_track(
+    request: Request,
+    scope: str = Query("track", pattern="^(track|collection)$"),
+    db: aiosqlite.Connection = Depends(get_db),
+    writer: aiosqlite.Connection = Depends(get_writer),
+) -> PlayerState:
+    # Get current collection for scope-aware skip
+    pos_str = await get_state(db, "shuffle_position")
+    current_coll_id = None
+    if pos_str:
+        cursor = await db.execute(
+            """SELECT t.collection_id FROM tracks t
+               JOIN shuffle_history sh ON sh.track_id = t.id
+               WHERE sh.id = ?""",
+            (int(pos_str),)
+        )
+        row = await cursor.fetchone()
+        if row:
+            current_coll_id = row["collection_id"]
+
+    return await _pick_next(db, writer, request.app.state, scope, current_coll_id)
 
 
 @router.post("/prev")
-async def prev_track() -> PlayerState:
-    db = await get_db()
-    try:
-        from app.database import get_state
-        pos_str = await get_state("shuffle_position")
-        if not pos_str:
-            raise HTTPException(404, "No playback history")
-
-        current_pos = int(pos_str)
-        cursor = await db.execute(
-            "SELECT * FROM shuffle_history WHERE id < ? ORDER BY id DESC LIMIT 1",
-            (current_pos,)
-        )
-        prev = await cursor.fetchone()
-        if not prev:
-            raise HTTPException(404, "No previous track")
+async def prev_track(
+    request: Request,
+    db: aiosqlite.Connection = Depends(get_db),
+    writer: aiosqlite.Connection = Depends(get_writer),
+) -> PlayerState:
+    pos_str = await get_state(db, "shuffle_position")
+    if not pos_str:
+        raise HTTPException(404, "No playback history")
+
+    current_pos = int(pos_str)
+    cursor = await db.execute(
+        "SELECT * FROM shuffle_history WHERE id < ? ORDER BY id DESC LIMIT 1",
+        (current_pos,)
+    )
+    prev = await cursor.fetchone()
+    if not prev:
+        raise HTTPException(404, "No previous track")
 
-        from app.database import set_state
-        await set_state("shuffle_position", str(prev["id"]))
+    await set_state(writer, "shuffle_position", str(prev["id"]))
 
-        cursor2 = await db.execute("SELECT * FROM tracks WHERE id=?", (prev["track_id"],))
-        track_row = await cursor2.fetchone()
-        if not track_row:
-            raise HTTPException(404, "Track not found")
+    cursor2 = await db.execute("SELECT * FROM tracks WHERE id=?", (prev["track_id"],))
+    track_row = await cursor2.fetchone()
+    if not track_row:
+        raise HTTPException(404, "Track not found")
 
-        return await _build_player_state(db, track_row)
-    finally:
-        await db.close()
+    return await _build_player_state(db, request.app.state, track_row, prev["id"])
 
 
 @router.get("/stream/{track_id}")
-async def stream_track(track_id: int):
-    db = await get_db()
-    try:
-        cursor = await db.execute("SELECT * FROM tracks WHERE id=?", (track_id,))
-        row = await cursor.fetchone()
-        if not row:
-            raise HTTPException(404, "Track not found")
-
-        track = dict(row)
+async def stream_track(
+    track_id: int,
+    request: Request,
+    db: aiosqlite.Connection = Depends(get_db),
+):
+    cursor = await db.execute("SELECT * FROM tracks WHERE id=?", (track_id,))
+    row = await cursor.fetchone()
+    if not row:
+        raise HTTPException(404, "Track not found")
 
-        # Increment play count
-        await db.execute(
-            "UPDATE tracks SET play_count = play_count + 1 WHERE id=?", (track_id,)
-        )
-        await db.commit()
-    finally:
-        await db.close()
+    track = dict(row)
 
-    path = await prepare_track(track)
+    path = await prepare_track(track, request.app.state.http)
     if path is None or not path.exists():
         raise HTTPException(503, "Failed to prepare track for streaming")
 
-    return FileResponse(
-        path=str(path),
-        media_type=content_type_for_path(path),
-        filename=path.name,
-    )
+    # Buffered; main._play_count_flusher writes these out periodically
+    request.app.state.play_counts[track_id] += 1
+
+    media_type = content_type_for_path(path)
+    if ACCEL_REDIRECT_PREFIX:
+        # nginx serves the file itself with sendfile
+        rel = quote(path.relative_to(CACHE_DIR).as_posix())
+        return Response(
+            media_type=media_type,
+            headers={"X-Accel-Redirect": ACCEL_REDIRECT_PREFIX + rel},
+        )
+    return _AudioFileResponse(path=str(path), media_type=media_type, filename=path.name)
+
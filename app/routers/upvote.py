@@ -1,11 +1,14 @@
+import asyncio
+import functools
 import logging
 import shutil
 from pathlib import Path
 from urllib.parse import urlparse, unquote
 
-from fastapi import APIRouter, HTTPException
+import aiosqlite
+from fastapi import APIRouter, Depends, HTTPException, Request
 
-from app.database import get_db
+from app.database import get_db, get_writer, transaction
 from app.audio import get_original_file
 from app.config import UPVOTED_DIR
 
@@ -13,6 +16,7 @@ log = logging.getLogger(__name__)
 router = APIRouter(prefix="/api/upvote", tags=["upvote"])
 
 
+@functools.lru_cache(maxsize=4096)
 def _upvote_path(remote_url: str, filename: str) -> Path:
     """Build the upvoted/ tree path mirroring the server structure."""
     parsed = urlparse(remote_url)
@@ -29,61 +33,62 @@ def _upvote_path(remote_url: str, filename: str) -> Path:
 
 
 @router.post("/{track_id}")
-async def upvote_track(track_id: int):
-    db = await get_db()
-    try:
-        cursor = await db.execute("SELECT * FROM tracks WHERE id=?", (track_id,))
-        row = await cursor.fetchone()
-        if not row:
-            raise HTTPException(404, "Track not found")
+async def upvote_track(
+    track_id: int,
+    request: Request,
+    db: aiosqlite.Connection = Depends(get_db),
+    writer: aiosqlite.Connection = Depends(get_writer),
+):
+    cursor = await db.execute("SELECT * FROM tracks WHERE id=?", (track_id,))
+    row = await cursor.fetchone()
+    if not row:
+        raise HTTPException(404, "Track not found")
 
-        track = dict(row)
+    track = dict(row)
 
-        if track["upvoted"]:
-            return {"status": "already_upvoted", "track_id": track_id}
+    if track["upvoted"]:
+        return {"status": "already_upvoted", "track_id": track_id}
 
-        # Download original file
-        original = await get_original_file(track)
-        if original is None:
-            raise HTTPException(503, "Failed to download original file")
+    # Download original file
+    original = await get_original_file(track, request.app.state.http)
+    if original is None:
+        raise HTTPException(503, "Failed to download original file")
 
-        # Copy to upvoted tree
-        dest = _upvote_path(track["remote_url"], track["filename"])
-        dest.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy2(str(original), str(dest))
+    # Copy to upvoted tree, off the event loop (copy2 uses sendfile on Linux)
+    dest = _upvote_path(track["remote_url"], track["filename"])
+    await asyncio.to_thread(dest.parent.mkdir, parents=True, exist_ok=True)
+    await asyncio.to_thread(shutil.copy2, str(original), str(dest))
 
-        # Mark as upvoted
-        await db.execute("UPDATE tracks SET upvoted=1 WHERE id=?", (track_id,))
-        await db.commit()
+    # Mark as upvoted
+    async with transaction(writer):
+        await writer.execute("UPDATE tracks SET upvoted=1 WHERE id=?", (track_id,))
 
-        log.info("Upvoted track %d -> %s", track_id, dest)
-        return {"status": "upvoted", "track_id": track_id, "saved_to": str(dest)}
-    finally:
-        await db.close()
+    log.info("Upvoted track %d -> %s", track_id, dest)
+    return {"status": "upvoted", "track_id": track_id, "saved_to": str(dest)}
 
 
 @router.delete("/{track_id}")
-async def remove_upvote(track_id: int):
-    db = await get_db()
-    try:
-        cursor = await db.execute("SELECT * FROM tracks WHERE id=?", (track_id,))
-        row = await cursor.fetchone()
-        if not row:
-            raise HTTPException(404, "Track not found")
-
-        track = dict(row)
-
-        if not track["upvoted"]:
-            return {"status": "not_upvoted", "track_id": track_id}
-
-        # Remove from upvoted tree
-        dest = _upvote_path(track["remote_url"], track["filename"])
-        dest.unlink(missing_ok=True)
-
-        # Clear flag
-        await db.execute("UPDATE tracks SET upvoted=0 WHERE id=?", (track_id,))
-        await db.commit()
-
-        return {"status": "removed", "track_id": track_id}
-    finally:
-        await db.close()
+async def remove_upvote(
+    track_id: int,
+    db: aiosqlite.Connection = Depends(get_db),
+    writer: aiosqlite.Connection = Depends(get_writer),
+):
+    cursor = await db.execute("SELECT * FROM tracks WHERE id=?", (track_id,))
+    row = await cursor.fetchone()
+    if not row:
+        raise HTTPException(404, "Track not found")
+
+    track = dict(row)
+
+    if not track["upvoted"]:
+        return {"status": "not_upvoted", "track_id": track_id}
+
+    # Remove from upvoted tree
+    dest = _upvote_path(track["remote_url"], track["filename"])
+    await asyncio.to_thread(dest.unlink, missing_ok=True)
+
+    # Clear flag
+    async with transaction(writer):
+        await writer.execute("UPDATE tracks SET upvoted=0 WHERE id=?", (track_id,))
+
+    return {"status": "removed", "track_id": track_id}
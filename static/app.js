@@ -320,33 +320,51 @@ async function loadCollections(category, query) {
     try {
         let url = `/api/collections?category=${encodeURIComponent(category)}&limit=100`;
         if (query) url += `&q=${encodeURIComponent(query)}`;
-        const collections = await api('GET', url);
+        const page = await api('GET', url);
         list.innerHTML = '';
-        if (collections.length === 0) {
+        if (page.items.length === 0) {
             list.innerHTML = '<div class="browse-item"><span class="info"><span class="name" style="color:var(--fg2)">No collections found</span></span></div>';
             return;
         }
-        collections.forEach(col => {
-            const item = document.createElement('div');
-            item.className = 'browse-item';
-            item.innerHTML = `
-                <span class="icon">&#9835;</span>
-                <span class="info">
-                    <span class="name">${esc(col.name)}</span>
-                    <span class="meta">${col.track_count} tracks</span>
-                </span>
-            `;
-            item.addEventListener('click', () => {
-                state.browseStack.push({ type: 'collection', id: col.id, name: col.name });
-                loadCollectionDetail(col.id, col.name);
-            });
-            list.appendChild(item);
-        });
+        appendCollections(list, url, page);
     } catch (e) {
         list.innerHTML = '<div class="browse-item"><span class="icon">!</span><span class="info"><span class="name">Failed to load</span></span></div>';
     }
 }
 
+function appendCollections(list, url, page) {
+    page.items.forEach(col => {
+        const item = document.createElement('div');
+        item.className = 'browse-item';
+        item.innerHTML = `
+            <span class="icon">&#9835;</span>
+            <span class="info">
+                <span class="name">${esc(col.name)}</span>
+                <span class="meta">${col.track_count} tracks</span>
+            </span>
+        `;
+        item.addEventListener('click', () => {
+            state.browseStack.push({ type: 'collection', id: col.id, name: col.name });
+            loadCollectionDetail(col.id, col.name);
+        });
+        list.appendChild(item);
+    });
+    if (!page.next_cursor) return;
+    const more = document.createElement('div');
+    more.className = 'browse-item';
+    more.innerHTML = '<span class="icon">&#8230;</span><span class="info"><span class="name">More</span></span>';
+    more.addEventListener('click', async () => {
+        more.remove();
+        try {
+            const next = await api('GET', `${url}&cursor=${encodeURIComponent(page.next_cursor)}`);
+            appendCollections(list, url, next);
+        } catch (e) {
+            list.appendChild(more);
+        }
+    });
+    list.appendChild(more);
+}
+
 async function loadCollectionDetail(id, name) {
     $('#browseTitle').textContent = name;
     $('#browseBack').style.display = 'block';